@@ -5,8 +5,10 @@ import os
 import datetime
 import time
 import io
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+import csv
+import hashlib
+import importlib.util
+import numpy as np
 from filelock import FileLock
 
 # ==============================
@@ -15,6 +17,16 @@ from filelock import FileLock
 CSV_PATH = "trouble_list.csv"
 LOCK_PATH = CSV_PATH + ".lock"
 ENCODING = "utf-8-sig"
+# 埋め込みのサイドカー（L2正規化済みベクトルと、行ごとのトラブル内容ハッシュを1ファイルに保存）
+# 類似度の順位付けにしか使わないので float16 で保存（サイズ・メモリ半分）
+EMB_DTYPE = np.float16
+EMB_PATH = os.path.splitext(CSV_PATH)[0] + ".emb.npz"
+
+# Sentence-BERT モデル
+MODEL_NAME = "sonoisa/sentence-bert-base-ja-mean-tokens"
+# ONNXエクスポート済みモデルの置き場所（無ければ PyTorch 版を使用）
+#   optimum-cli export onnx --model sonoisa/sentence-bert-base-ja-mean-tokens ./onnx_model
+ONNX_MODEL_DIR = "onnx_model"
 
 # CSVの列定義（完全一致で維持）
 COLUMNS = [
@@ -52,22 +64,162 @@ if MAIN_PASSWORD is None or REGISTER_PASSWORD is None:
 # ==============================
 # モデル読み込み（キャッシュ）
 # ==============================
+class OnnxSentenceEncoder:
+    """ONNX Runtime 版 Sentence-BERT（mean pooling）。SentenceTransformer.encode と同じ呼び方で numpy を返す。"""
+
+    def __init__(self, model_dir: str):
+        import onnxruntime as ort
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        # LayerNorm/GELU/Attention の融合や定数畳み込みを全て有効化
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, provider="CPUExecutionProvider", session_options=session_options
+        )
+        self.dim = self.model.config.hidden_size
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, **kwargs) -> np.ndarray:
+        # 長さ順に並べてからバッチ化し、PADトークンへの無駄な計算を減らす（最後に元の順へ戻す）
+        order = np.argsort([len(t) for t in sentences], kind="stable")
+        sorted_sentences = [sentences[i] for i in order]
+        chunks = []
+        for start in range(0, len(sorted_sentences), batch_size):
+            batch = sorted_sentences[start:start + batch_size]
+            inputs = self.tokenizer(batch, padding=True, truncation=True, return_tensors="np")
+            hidden = self.model(**inputs).last_hidden_state
+            # PADを除いたトークン平均（sentence-transformers の mean pooling と同じ）
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            chunks.append(pooled.astype(np.float32))
+        embs = np.empty((len(sorted_sentences), self.dim), dtype=np.float32)
+        if chunks:
+            embs[order] = np.concatenate(chunks)
+        if normalize_embeddings:
+            embs /= np.clip(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12, None)
+        return embs
+
+def use_onnx_backend() -> bool:
+    """エクスポート済みONNXモデルと optimum/onnxruntime が揃っていれば True（モデル自体は読み込まない）"""
+    return os.path.isdir(ONNX_MODEL_DIR) and all(
+        importlib.util.find_spec(m) is not None for m in ("optimum", "onnxruntime")
+    )
+
+def embedding_model_id() -> str:
+    """埋め込みを作るモデル・バックエンドの識別子。サイドカーに記録し、変わったら作り直す。"""
+    if use_onnx_backend():
+        return f"onnx:{ONNX_MODEL_DIR}"
+    return f"torch-int8:{MODEL_NAME}"
+
+# ログイン画面で torch/transformers を読み込まないよう、初回のエンコード時まで読み込みを遅延させる
 @st.cache_resource
-def load_model():
+def get_model():
+    # エクスポート済みONNXモデルがあれば ONNX Runtime で推論（optimum未導入なら PyTorch 版）
+    if use_onnx_backend():
+        return OnnxSentenceEncoder(ONNX_MODEL_DIR)
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    # コンテナのCPU数に合わせてintra-opスレッドを設定（inter-opはbatch=1では不要）
+    torch.set_num_threads(max(1, os.cpu_count() or 1))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # 既に並列処理が走った後は変更できない（再読み込み時など）
+        pass
     # 日本語Sentence-BERT（モデルは必要に応じて軽量モデルへ変更可）
-    return SentenceTransformer("sonoisa/sentence-bert-base-ja-mean-tokens")
+    model = SentenceTransformer(MODEL_NAME, device="cpu")
+    # CPU推論向けに Linear 層を int8 動的量子化（プーリング等のパイプラインはそのまま）
+    transformer = model._first_module()
+    transformer.auto_model = torch.quantization.quantize_dynamic(
+        transformer.auto_model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return model
+
+def encode_sentences(texts: list) -> np.ndarray:
+    """L2正規化済み float32 の埋め込み。autograd を切った推論専用モードで実行。"""
+    import torch
 
-model = load_model()
+    model = get_model()
+    with torch.inference_mode():
+        embs = model.encode(texts, batch_size=32, convert_to_numpy=True, normalize_embeddings=True)
+    return embs.astype(np.float32)
 
 # ==============================
 # ユーティリティ
 # ==============================
+def feather_path_for(csv_path: str) -> str:
+    """CSVに対応するFeatherミラーのパス"""
+    return os.path.splitext(csv_path)[0] + ".feather"
+
+def write_feather_mirror(df: pd.DataFrame, csv_path: str):
+    """読み込み高速化用のFeatherミラーを書き出す。呼び出し側で LOCK_PATH のロックを取得済みであること。
+    CSVは人が見る用・ダウンロード用としてそのまま残す。"""
+    feather_path = feather_path_for(csv_path)
+    try:
+        mirror = df.reset_index(drop=True)
+        # CSV再読込時と同じく、文字列と数値が混在する列は文字列に揃える（Arrowは混在型を書けない）
+        for c in mirror.columns[mirror.dtypes == object]:
+            mirror[c] = mirror[c].map(lambda v: v if isinstance(v, str) or pd.isna(v) else str(v))
+        tmp_path = feather_path + ".tmp"
+        mirror.to_feather(tmp_path)
+        os.replace(tmp_path, feather_path)
+    except Exception:
+        # 書けなければ古いミラーを消してCSV読み込みに戻す
+        remove_feather_mirror(csv_path)
+
+def remove_feather_mirror(csv_path: str):
+    """古くなったFeatherミラーを削除。呼び出し側で LOCK_PATH のロックを取得済みであること。"""
+    feather_path = feather_path_for(csv_path)
+    if os.path.exists(feather_path):
+        os.remove(feather_path)
+
+def is_feather_mirror_fresh(csv_path: str) -> bool:
+    """FeatherミラーがCSVと同じか新しければ True"""
+    feather_path = feather_path_for(csv_path)
+    return os.path.exists(feather_path) and os.path.getmtime(feather_path) >= os.path.getmtime(csv_path)
+
+def read_csv_arrow(path: str, encoding: str = ENCODING) -> pd.DataFrame:
+    """pyarrow のCSVパーサで読み込む（型推論なし・全列文字列、セル内改行あり）。COLUMNS 以外の列は読まない。"""
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    # pyarrow は UTF-8 の BOM を自動で読み飛ばすので、utf-8-sig は変換不要
+    arrow_encoding = "utf8" if encoding.lower().replace("-", "") in ("utf8", "utf8sig") else encoding
+    with open(path, "r", encoding=encoding, newline="") as f:
+        header = next(csv.reader(f), [])
+    table = pacsv.read_csv(
+        path,
+        read_options=pacsv.ReadOptions(encoding=arrow_encoding),
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=[c for c in header if c in COLUMNS],
+            column_types={c: pa.string() for c in COLUMNS},
+            strings_can_be_null=True,
+        ),
+    )
+    return table.to_pandas()
+
 def safe_read_csv(path: str, encoding: str = ENCODING) -> pd.DataFrame:
-    """壊れたCSVでも落ちないように読み込み。列が欠けたら補完、順序は既存に合わせる。"""
+    """壊れたCSVでも落ちないように読み込み。列が欠けたら補完、順序は既存に合わせる。
+    CSVより新しいFeatherミラーがあればそちらを優先して読む。"""
     if not os.path.exists(path):
         return pd.DataFrame(columns=COLUMNS)
     try:
-        df = pd.read_csv(path, encoding=encoding)
+        df = None
+        if is_feather_mirror_fresh(path):
+            try:
+                df = pd.read_feather(feather_path_for(path))
+            except Exception:
+                df = None
+        if df is None:
+            try:
+                df = read_csv_arrow(path, encoding)
+            except Exception:
+                df = pd.read_csv(path, encoding=encoding, usecols=lambda c: c in COLUMNS, dtype=str)
         # 列の補完と並べ替え
         for c in COLUMNS:
             if c not in df.columns:
@@ -75,28 +227,184 @@ def safe_read_csv(path: str, encoding: str = ENCODING) -> pd.DataFrame:
         # 既存の列はそのまま優先、足りない列は末尾に
         ordered = [c for c in df.columns if c in COLUMNS] + [c for c in COLUMNS if c not in df.columns]
         df = df[ordered]
+        # 種類の少ない列はカテゴリ型に（フィルター比較・unique が高速、メモリも小さい）
+        for c in ("設備名", "発生拠点"):
+            df[c] = df[c].astype("category")
         return df
     except Exception as e:
         st.error(f"CSV読み込みに失敗しました: {e}")
         return pd.DataFrame(columns=COLUMNS)
 
-def find_similar_troubles_bert(input_trouble: str, df: pd.DataFrame, top_n: int = 5) -> pd.DataFrame:
-    """BERT類似検索。トラブル内容が空しかない場合は空の結果を返す。"""
-    if df.empty or df["トラブル内容"].dropna().empty:
-        return pd.DataFrame(columns=df.columns)
-    troubles = df["トラブル内容"].fillna("").tolist()
-    # 全て空なら検索しない
-    if all(t.strip() == "" for t in troubles):
-        return pd.DataFrame(columns=df.columns)
-    sentences = troubles + [input_trouble]
-    embeddings = model.encode(sentences)
-    input_vec = embeddings[-1].reshape(1, -1)
-    trouble_vecs = embeddings[:-1]
-    cosine_sim = cosine_similarity(input_vec, trouble_vecs)
-    top_indices = cosine_sim[0].argsort()[-top_n:][::-1]
+def read_trouble_list(csv_path: str = CSV_PATH) -> pd.DataFrame:
+    """画面表示用の読み込み。Featherミラーが古い（追記後など）ときは、ロックを取ってCSVから読み直しミラーを作り直す。"""
+    csv_abs = os.path.abspath(csv_path)
+    if not os.path.exists(csv_abs) or is_feather_mirror_fresh(csv_abs):
+        return safe_read_csv(csv_abs)
+    try:
+        with FileLock(os.path.abspath(LOCK_PATH), timeout=10):
+            df = safe_read_csv(csv_abs)
+            # 読み込み失敗時（空で返る）に空のミラーを作らない
+            if not df.empty:
+                write_feather_mirror(df, csv_abs)
+        return df
+    except OSError:
+        # ミラー更新はあくまで任意。登録中でロックが取れない（Timeout）・ロックファイルやミラーを
+        # 作成／削除できない場合は諦めてCSVを読む（検索ページに書き込み権限を要求しない）
+        return safe_read_csv(csv_abs)
+
+def append_csv_row(csv_path: str, row: dict) -> bool:
+    """1行だけCSV末尾に追記（全体の書き直しをしない）。呼び出し側で LOCK_PATH のロックを取得済みであること。
+    ヘッダーは新規・空ファイルのときだけ書く。既存ヘッダーに足りない列がある場合は追記せず False を返す。"""
+    header = None
+    needs_newline = False
+    if os.path.exists(csv_path) and os.path.getsize(csv_path) > 0:
+        with open(csv_path, "r", encoding=ENCODING, newline="") as f:
+            header = next(csv.reader(f), [])
+        if not set(COLUMNS) <= set(header):
+            return False
+        # 末尾が改行で終わっていないと前の行に連結されてしまう
+        with open(csv_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) not in (b"\n", b"\r")
+    # 既存の列順（ヘッダー）に合わせて書く
+    with open(csv_path, "a", encoding=ENCODING, newline="") as f:
+        if needs_newline:
+            f.write("\n")
+        writer = csv.writer(f, lineterminator="\n")
+        if header is None:
+            header = COLUMNS
+            writer.writerow(header)
+        writer.writerow([row.get(c, "") for c in header])
+    return True
+
+# CSVが更新されたら古い版は不要なので、最新の1件だけ保持
+@st.cache_data(show_spinner=False, max_entries=1)
+def load_df(csv_mtime: float) -> pd.DataFrame:
+    """検索ページ用の一覧。CSV更新時刻をキーにキャッシュ（新規登録ページでは読み込まない）"""
+    return read_trouble_list(CSV_PATH)
+
+def hash_texts(texts) -> np.ndarray:
+    """トラブル内容を行ごとに blake2b(16byte) でハッシュ化。"""
+    return np.array([hashlib.blake2b(t.encode("utf-8"), digest_size=16).digest() for t in texts], dtype="S16")
+
+def save_sidecar_atomic(path: str, **arrays):
+    """一時ファイルに書いてから置き換え（書き込み途中のファイルを読ませない）"""
+    tmp_path = path[:-len(".npz")] + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+def load_embedding_sidecar(model_id: str) -> tuple[np.ndarray, np.ndarray]:
+    """サイドカー（埋め込み・行ハッシュ）を読み込む。無い・壊れている・別モデルで作られた場合は空を返す。
+    1ファイルを置き換えで更新しているので、ロック無しで読んでも埋め込みとハッシュの組は必ず一致する。"""
+    empty = (np.empty((0, 0), dtype=EMB_DTYPE), np.empty(0, dtype="S16"))
+    emb_abs = os.path.abspath(EMB_PATH)
+    if not os.path.exists(emb_abs):
+        return empty
+    try:
+        with np.load(emb_abs) as data:
+            if str(data["model"]) != model_id:
+                return empty
+            embs, hashes = data["embs"], data["hashes"]
+    except (OSError, ValueError, KeyError):
+        return empty
+    if embs.ndim != 2 or len(embs) != len(hashes):
+        return empty
+    return embs, hashes
+
+def sync_embedding_sidecar(texts: list) -> np.ndarray:
+    """サイドカーの埋め込みを読み込み、ハッシュが変わった（新規・変更）行だけエンコードして書き戻す。
+    エンコードはロック外で行い、ロックは書き込みの間だけ取る。戻り値は texts の行順に対応する埋め込み。"""
+    if not texts:
+        return np.empty((0, 0), dtype=EMB_DTYPE)
+    hashes = hash_texts(texts)
+    model_id = embedding_model_id()
+    old_embs, old_hashes = load_embedding_sidecar(model_id)
+    # 変更なしならそのまま返す（旧形式 float32 のサイドカーは書き直す）
+    if np.array_equal(old_hashes, hashes) and old_embs.dtype == EMB_DTYPE:
+        return old_embs
+
+    lookup = {h: i for i, h in enumerate(old_hashes)}
+    old_pos = [lookup.get(h) for h in hashes]
+    missing = [i for i, p in enumerate(old_pos) if p is None]
+    new_embs = None
+    if missing:
+        new_embs = encode_sentences([texts[i] for i in missing])
+    kept = [(i, p) for i, p in enumerate(old_pos) if p is not None]
+    if kept and new_embs is not None and new_embs.shape[1] != old_embs.shape[1]:
+        # 次元が合わない（壊れた）サイドカーは使わず全件エンコードし直す
+        kept, missing = [], list(range(len(texts)))
+        new_embs = encode_sentences(texts)
+    dim = new_embs.shape[1] if new_embs is not None else old_embs.shape[1]
+    embs = np.empty((len(texts), dim), dtype=EMB_DTYPE)
+    if kept:
+        rows, src = zip(*kept)
+        embs[list(rows)] = old_embs[list(src)]
+    if new_embs is not None:
+        embs[missing] = new_embs
+    # 保存は任意（次回また同期できる）なので、検索を待たせないよう短いタイムアウトで試す
+    try:
+        with FileLock(os.path.abspath(LOCK_PATH), timeout=1):
+            save_sidecar_atomic(os.path.abspath(EMB_PATH), embs=embs, hashes=hashes, model=np.array(model_id))
+    except OSError:
+        # 登録中でロックが取れない（Timeout）・置き換えできない場合は保存を諦め、今回の結果だけ返す
+        # （次回の同期で保存される）
+        pass
+    return embs
+
+def encode_for_sidecar(text: str) -> np.ndarray:
+    """新規登録行をロック取得前にエンコードしておく。サイドカーが未作成・不整合で追記できない場合は
+    エンコードせず None を返す（次回検索時の同期で補完される）。"""
+    old_embs, old_hashes = load_embedding_sidecar(embedding_model_id())
+    if len(old_hashes) == 0 or old_embs.dtype != EMB_DTYPE:
+        return None
+    new_emb = encode_sentences([text]).astype(EMB_DTYPE)
+    if old_embs.shape[1] != new_emb.shape[1]:
+        return None
+    return new_emb
+
+def append_embedding_sidecar(text: str, new_emb: np.ndarray):
+    """エンコード済みの新規行をサイドカー末尾に追記。呼び出し側で LOCK_PATH のロックを取得済みであること。
+    ロック待ちの間にサイドカーが変わって追記できなくなっていたら何もしない。"""
+    model_id = embedding_model_id()
+    old_embs, old_hashes = load_embedding_sidecar(model_id)
+    if len(old_hashes) == 0 or old_embs.dtype != EMB_DTYPE or old_embs.shape[1] != new_emb.shape[1]:
+        return
+    save_sidecar_atomic(os.path.abspath(EMB_PATH), embs=np.concatenate([old_embs, new_emb]),
+                        hashes=np.concatenate([old_hashes, hash_texts([text])]), model=np.array(model_id))
+
+# CSVが更新されたら古い版は不要なので、最新の1件だけ保持（登録のたびにメモリが増えないように）
+@st.cache_data(show_spinner=False, max_entries=1)
+def get_corpus_embeddings(csv_mtime: float, texts: tuple[str, ...]) -> np.ndarray:
+    """トラブル内容コーパスの埋め込み（L2正規化済み）。CSV更新時刻と本文をキーにキャッシュ。
+    float16 はディスク上だけ。numpy の float16 行列演算は BLAS を使わず遅いので、ここで一度だけ float32 に戻す。"""
+    return np.ascontiguousarray(sync_embedding_sidecar(list(texts)), dtype=np.float32)
+
+def find_similar_troubles_bert(input_trouble: str, df: pd.DataFrame, corpus_embs: np.ndarray,
+                               top_n: int = 5) -> pd.DataFrame:
+    """BERT類似検索。corpus_embs は df の行順に対応する埋め込み。トラブル内容が空しかない場合は空の結果を返す。"""
+    # 0件・全て空なら検索しない（Pythonループではなくpandasのベクトル演算で判定）
+    if not df["トラブル内容"].fillna("").astype(str).str.strip().astype(bool).any():
+        return df.iloc[0:0]
+    # クエリ文だけをエンコード（コーパス側はキャッシュ済み）
+    input_vec = encode_sentences([input_trouble])[0]
+    # 両側ともL2正規化済みなので、内積＝コサイン類似度（corpus_embs はキャッシュ済みの float32）
+    sims = corpus_embs @ input_vec
+    # 上位top_nだけを部分選択（O(N)）してから、その中だけ降順ソート
+    top_n = min(top_n, len(sims))
+    idx = np.argpartition(sims, -top_n)[-top_n:] if top_n < len(sims) else np.arange(len(sims))
+    top_indices = idx[np.argsort(-sims[idx])]
     # インデックスがdfと対応するように、元の行番号を拾う
     return df.iloc[top_indices]
 
+# CSVが更新されたら古いエクスポートは不要なので、最新の1件だけ保持
+@st.cache_data(show_spinner=False, max_entries=1)
+def build_xlsx(csv_mtime: float, csv_size: int, _df: pd.DataFrame) -> bytes:
+    """Excelエクスポート用バイト列。CSVの更新時刻・サイズをキーにキャッシュ（_df はハッシュ対象外）。"""
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        _df.to_excel(writer, index=False, sheet_name="TroubleList")
+    return output.getvalue()
+
 def check_password(main_password: str) -> bool:
     """共通パスワード認証（Secrets由来）"""
     def password_entered():
@@ -131,6 +439,38 @@ def check_register_password(register_password: str) -> bool:
     else:
         return True
 
+def read_tail_lines(path: str, max_bytes: int = 8192) -> tuple[list, bool]:
+    """ファイル末尾 max_bytes だけを行リストで返す（ファイルサイズに関係なくメモリ一定）。
+    途中から読んだ場合は先頭の切れた行を捨てる。2つ目の戻り値はファイル全体を読んだかどうか。"""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        f.seek(-min(max_bytes, size), os.SEEK_END)
+        data = f.read()
+    whole = size <= max_bytes
+    # マルチバイト文字の途中で切れた部分は無視
+    lines = data.decode(ENCODING, errors="ignore").splitlines()
+    return (lines if whole else lines[1:]), whole
+
+def read_csv_tail_rows(path: str, n: int, max_bytes: int = 8192) -> pd.DataFrame:
+    """CSV末尾 n 行を DataFrame で返す。末尾 max_bytes とヘッダー行だけを読んで解析する。
+    途中から読むと本来の行番号は分からないので、インデックスは 0 始まりの連番に振り直す。"""
+    tail_lines, whole = read_tail_lines(path, max_bytes)
+    if whole:
+        return pd.read_csv(path, encoding=ENCODING).tail(n).reset_index(drop=True)
+    with open(path, "r", encoding=ENCODING, newline="") as f:
+        header_line = f.readline()
+    n_cols = len(next(csv.reader([header_line])))
+    # セル内改行の途中から始まっている可能性があるので、列数が揃う最初の行から解析する
+    for start in range(len(tail_lines)):
+        chunk = "\n".join(tail_lines[start:])
+        rows = [r for r in csv.reader(io.StringIO(chunk)) if r]
+        if rows and all(len(r) == n_cols for r in rows):
+            if len(rows) < n:
+                break
+            return pd.read_csv(io.StringIO(header_line + chunk)).tail(n).reset_index(drop=True)
+    # n 行に満たない（1レコードが長い）場合は読む範囲を広げる
+    return read_csv_tail_rows(path, n, max_bytes * 2)
+
 def show_diagnostics(csv_path: str):
     """診断表示：絶対パス・サイズ・更新時刻・末尾行・pandas末尾"""
     csv_abs = os.path.abspath(csv_path)
@@ -140,24 +480,18 @@ def show_diagnostics(csv_path: str):
         mtime = datetime.datetime.fromtimestamp(os.path.getmtime(csv_abs))
         st.write("🕒 最終更新:", mtime.strftime("%Y/%m/%d %H:%M:%S"))
         try:
-            with open(csv_abs, "r", encoding=ENCODING) as f:
-                tail_lines = f.read().splitlines()[-5:]
+            tail_lines = read_tail_lines(csv_abs)[0][-5:]
             st.code("\n".join(tail_lines), language="text")
         except Exception as e:
             st.warning(f"末尾テキストの読込に失敗: {e}")
         try:
-            tail_df = pd.read_csv(csv_abs, encoding=ENCODING).tail(3)
-            st.write("🧪 pandasでの末尾3行:", tail_df)
+            tail_df = read_csv_tail_rows(csv_abs, 3)
+            st.write("🧪 pandasでの末尾3行（インデックスは末尾3行内の連番で、CSVの行番号ではありません）:", tail_df)
         except Exception as e:
             st.warning(f"pandas読込に失敗: {e}")
     else:
         st.error("❌ CSVファイルが存在しません。パスの誤認かも。")
 
-# ==============================
-# 起動時のデータ読み込み
-# ==============================
-df = safe_read_csv(CSV_PATH)
-
 # ==============================
 # 画面構成
 # ==============================
@@ -195,44 +529,65 @@ page = st.sidebar.radio("ページを選択", ["🔍 トラブル検索", "📝
 # ==============================
 if page == "🔍 トラブル検索":
     st.subheader("🔍 トラブル検索")
+    csv_mtime = os.path.getmtime(CSV_PATH) if os.path.exists(CSV_PATH) else 0.0
+    df = load_df(csv_mtime)
     equipment_options = ["すべて"] + sorted(df["設備名"].dropna().unique().tolist())
-    selected_equipment = st.selectbox("🏭 設備名でフィルター", equipment_options)
-    input_trouble = st.text_input("💬 トラブル内容を入力してください")
-
-    filtered_df = df.copy()
-    if selected_equipment != "すべて":
-        filtered_df = filtered_df[filtered_df["設備名"] == selected_equipment]
-
-    # 類似検索
-    if st.button("検索") and input_trouble.strip():
-        similar_df = find_similar_troubles_bert(input_trouble, filtered_df)
+    # 入力はフォームにまとめ、「検索」押下時だけ再計算する
+    with st.form("search_form"):
+        selected_equipment = st.selectbox("🏭 設備名でフィルター", equipment_options)
+        input_trouble = st.text_input("💬 トラブル内容を入力してください")
+        search_submitted = st.form_submit_button("検索")
+
+    # 類似検索（同じ条件・同じCSVなら前回結果を再利用）
+    if search_submitted and input_trouble.strip():
+        search_key = (csv_mtime, selected_equipment, input_trouble)
+        last_search = st.session_state.get("last_search")
+        if last_search is None or last_search[0] != search_key:
+            # フィルター無しならコピーせずそのまま使う（検索側で変更しないのでビューで十分）
+            equipment_mask = None if selected_equipment == "すべて" else (df["設備名"].values == selected_equipment)
+            filtered_df = df if equipment_mask is None else df[equipment_mask]
+            # コーパス全体の埋め込みはCSV更新時刻＋本文でキャッシュし、フィルター後の行だけ取り出す
+            corpus_embs = get_corpus_embeddings(csv_mtime, tuple(df["トラブル内容"].fillna("").tolist()))
+            filtered_embs = corpus_embs if equipment_mask is None else corpus_embs[equipment_mask]
+            similar_df = find_similar_troubles_bert(input_trouble, filtered_df, filtered_embs)
+            st.session_state["last_search"] = (search_key, similar_df)
+    elif search_submitted:
+        # 空のまま検索したら前回結果は消す
+        st.session_state.pop("last_search", None)
+
+    # 検索結果の表示（他のウィジェット操作による再実行でも前回結果を表示し続ける）
+    # CSVが更新された（新規登録など）後は古い結果を表示しない
+    last_search = st.session_state.get("last_search")
+    if last_search is not None and last_search[0][0] == csv_mtime:
+        similar_df = last_search[1]
         if similar_df.empty:
             st.info("該当する類似トラブルが見つかりませんでした。")
         else:
+            # 1件につき1要素で描画（項目ごとに st.write すると要素数・通信が増える）
             for _, row in similar_df.iterrows():
-                st.markdown("### 🛠 類似トラブル")
-                st.write(f"📍 **発生拠点**: {row['発生拠点']}")
-                st.write(f"📅 **発生年月日**: {row['発生年月日']}")
-                st.write(f"🔢 **成形機No.**: {row['成形機No.']}")
-                st.write(f"🏭 **設備名**: {row['設備名']}")
-                st.write(f"💬 **トラブル内容**: {row['トラブル内容']}")
-                st.write(f"🛠 **原因**: {row['原因']}")
-                st.write(f"🧪 **是正内容**: {row['是正内容']}")
-                st.write(f"⏱ **対応時間(h)**: {row['対応時間(h)']}")
-                st.write(f"👤 **対応者**: {row['対応者']}")
-                st.write(f"🔎 **調査過程**: {row['調査過程']}")
-                st.write(f"⚠️ **調査時の注意点**: {row['調査時の注意点']}")
-                st.markdown("---")
+                st.markdown("\n\n".join([
+                    "### 🛠 類似トラブル",
+                    f"📍 **発生拠点**: {row['発生拠点']}",
+                    f"📅 **発生年月日**: {row['発生年月日']}",
+                    f"🔢 **成形機No.**: {row['成形機No.']}",
+                    f"🏭 **設備名**: {row['設備名']}",
+                    f"💬 **トラブル内容**: {row['トラブル内容']}",
+                    f"🛠 **原因**: {row['原因']}",
+                    f"🧪 **是正内容**: {row['是正内容']}",
+                    f"⏱ **対応時間(h)**: {row['対応時間(h)']}",
+                    f"👤 **対応者**: {row['対応者']}",
+                    f"🔎 **調査過程**: {row['調査過程']}",
+                    f"⚠️ **調査時の注意点**: {row['調査時の注意点']}",
+                    "---",
+                ]))
 
     # エクスポート
     if not df.empty:
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-            df.to_excel(writer, index=False, sheet_name="TroubleList")
-        output.seek(0)
+        # CSVが変わっていなければ、再実行時もxlsxwriterを回さずキャッシュ済みバイト列を使う
+        csv_stat = os.stat(CSV_PATH)
         st.download_button(
             label="📥 トラブルリストダウンロード",
-            data=output,
+            data=build_xlsx(csv_stat.st_mtime, csv_stat.st_size, df),
             file_name="trouble_list.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
@@ -299,25 +654,42 @@ elif page == "📝 新規登録":
                 }
                 new_df = pd.DataFrame([new_row], columns=COLUMNS)
 
-                # --- ロック取得＆読み込み→結合→上書き ---
+                # --- 埋め込みはロックの外で先に計算（ロック中にモデル読み込み・推論をしない） ---
+                try:
+                    new_emb = encode_for_sidecar(new_row["トラブル内容"])
+                except Exception:
+                    new_emb = None
+
+                # --- ロック取得＆1行追記（列が欠けた古いCSVのみ読み込み→結合→上書き） ---
                 csv_abs = os.path.abspath(CSV_PATH)
                 lock_abs = os.path.abspath(LOCK_PATH)
                 with FileLock(lock_abs, timeout=10):
-                    existing = safe_read_csv(csv_abs)
-                    # 既存の列順に合わせて結合
-                    for c in existing.columns:
-                        if c not in new_df.columns:
-                            new_df[c] = ""
-                    combined = pd.concat([existing, new_df[existing.columns]], ignore_index=True)
-                    # 上書き保存（ヘッダーは常に1回）
-                    combined.to_csv(csv_abs, index=False, encoding=ENCODING, lineterminator="\n")
+                    if append_csv_row(csv_abs, new_row):
+                        # ミラーは古くなるので削除（次回の一覧読み込み時に作り直す）
+                        remove_feather_mirror(csv_abs)
+                    else:
+                        existing = safe_read_csv(csv_abs)
+                        # 既存の列順に合わせて結合
+                        for c in existing.columns:
+                            if c not in new_df.columns:
+                                new_df[c] = ""
+                        combined = pd.concat([existing, new_df[existing.columns]], ignore_index=True)
+                        # 上書き保存（ヘッダーは常に1回）
+                        combined.to_csv(csv_abs, index=False, encoding=ENCODING, lineterminator="\n")
+                        write_feather_mirror(combined, csv_abs)
+                    # 埋め込みサイドカーにも新規行だけ追記（失敗しても次回検索時の同期で補完される）
+                    if new_emb is not None:
+                        try:
+                            append_embedding_sidecar(new_row["トラブル内容"], new_emb)
+                        except Exception:
+                            pass
 
                 # --- 書き込み直後の確認（任意） ---
                 if diagnostics_enabled:
                     st.markdown("#### 🈺 登録直後の確認")
                     try:
-                        tail = pd.read_csv(csv_abs, encoding=ENCODING).tail(3)
-                        st.write("末尾3行:", tail)
+                        tail = read_csv_tail_rows(csv_abs, 3)
+                        st.write("末尾3行（インデックスは末尾3行内の連番で、CSVの行番号ではありません）:", tail)
                     except Exception as e:
                         st.warning(f"登録後の確認読み込みに失敗: {e}")
 